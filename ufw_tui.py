@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
 
-import curses, subprocess, re
-from typing import Literal, Optional
+from __future__ import annotations
+
+import bisect, curses, subprocess, re, threading, time
 from curses import window
 
+# Avoid importing typing at runtime, it is only needed for the annotations
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Literal
+
+
+# Never prompt for a password, the credentials are cached before curses starts
+_SUDO = ['sudo', '-n']
+
+# Match groups:
+# 1: Denyed (!) or allowed (empty)
+# 2: Port number
+# 3: Protocol
+_USER_PORT_RE = re.compile(r'(!)?(\w+)(?:/(tcp|udp))?')
+
 
 class Port:
     """A port object"""
@@ -16,33 +32,42 @@ class Port:
         self.port_num = port_num
         self.allowed = allowed
         self.protocol = protocol
+        
+        # The protocol never changes, so build the ufw port string once
+        if protocol == 'any':
+            self._str_port = port_num
+        elif protocol == 'tcp' or protocol == 'udp':
+            self._str_port = f'{port_num}/{protocol}'
+        else:
+            raise ValueError(f'Invalid protocol: {protocol}')
+        
+        # Numeric ports sort by value, service names (e.g. OpenSSH) after them
+        self._sort_key = (0, int(port_num)) if port_num.isdecimal() else (1, port_num)
+        self._refresh_display()
     
     
     def str_port(self) -> str:
-        if self.protocol == 'any':
-            return self.port_num
-        elif self.protocol == 'tcp' or self.protocol == 'udp':
-            return f'{self.port_num}/{self.protocol}'
-        else:
-            raise ValueError(f'Invalid protocol: {self.protocol}')
+        return self._str_port
     
         
     def allow(self) -> None:
-        subprocess.run(['sudo', 'ufw', 'allow', self.str_port()])
+        subprocess.run(_SUDO + ['ufw', 'allow', self.str_port()], capture_output=True, check=True)
         self.allowed = True
+        self._refresh_display()
         
     
     def deny(self) -> None:
-        subprocess.run(['sudo', 'ufw', 'deny', self.str_port()])
+        subprocess.run(_SUDO + ['ufw', 'deny', self.str_port()], capture_output=True, check=True)
         self.allowed = False
+        self._refresh_display()
     
 
     def delete(self) -> None:
-        subprocess.run([
-            'sudo', 'ufw', 'delete',
+        subprocess.run(_SUDO + [
+            'ufw', 'delete',
             'allow' if self.allowed else 'deny',
             self.str_port()
-        ])
+        ], capture_output=True, check=True)
 
 
     def toggle(self) -> None:
@@ -58,50 +83,138 @@ class Port:
     
     def str_allowed(self) -> str:
         return 'ALLOWED' if self.allowed else 'DENIED'
+    
+    
+    def _refresh_display(self) -> None:
+        """Update the cached line shown in the port list"""
+        self._display = f'{self.str_port().ljust(15)} {self.str_allowed()}'
 
 
 
-def get_ports() -> list[Port]:
+def _parse_ufw_line(line: bytes) -> tuple[bytes, bool, bytes] | None:
+    """Parse a single line of `ufw status numbered`
+
+    :param line: Line to parse
+    :return tuple[bytes, bool, bytes] | None: Port number, allowed and protocol, None if the line is not a port rule
+    """
+    # Rule lines start with the rule number, e.g. `[ 1]`
+    if not line.startswith(b'['):
+        return None
+    
+    end = line.find(b']')
+    if end == -1:
+        return None
+    
+    # Fields: port[/protocol], optional (v6), ALLOW or DENY, ...
+    fields = line[end + 1:].split(None, 3)
+    action_idx = 2 if len(fields) > 1 and fields[1] == b'(v6)' else 1
+    if len(fields) <= action_idx or fields[action_idx] not in (b'ALLOW', b'DENY'):
+        return None
+    
+    port_num, _, protocol = fields[0].partition(b'/')
+    if not port_num.isalnum() or protocol not in (b'', b'tcp', b'udp'):
+        return None
+    
+    return port_num, fields[action_idx] == b'ALLOW', protocol
+
+
+def get_ports() -> tuple[list[Port], list[str]]:
     """Get a list of ports
 
     :raises ValueError: An error occured while getting the ports
     :raises ValueError: The amount of ports are not diviced by 2
-    :return Port: A list of Port objects
+    :return tuple[list[Port], list[str]]: A list of Port objects and the rules that could not be parsed
     """
-    result = subprocess.run(['sudo', 'ufw', 'status', 'numbered'], capture_output=True, text=True)
-    lines = result.stdout.splitlines()
+    result = subprocess.run(_SUDO + ['ufw', 'status', 'numbered'], capture_output=True)
+    if result.returncode != 0:
+        raise ValueError(f'Could not get the ports: {error_message(result.stderr, result.returncode)}')
     
-    port_lst = []
-    port_line_lst = [line for line in lines if re.match(r'^\[\s*(\d+)\]', line)]
+    # The fields are plain ASCII, so parse the raw bytes instead of decoding everything
+    rule_lst = []
+    skipped_lst = []
+    for line in result.stdout.splitlines():
+        rule = _parse_ufw_line(line)
+        if rule is not None:
+            rule_lst.append(rule)
+        
+        # Rules that are not a single port (e.g. `Nginx Full` or `6000:6007/tcp`)
+        elif line.startswith(b'[') and b'(v6)' not in line:
+            skipped_lst.append(line.decode(errors='replace').strip())
     
     # Raise and error if the amount of ports are not diviced by 2
-    if len(port_line_lst) % 2 != 0:
+    if len(rule_lst) % 2 != 0:
         raise ValueError('The amount of ports are not diviced by 2')
     
-    # Cut the port_line_lst in half
-    port_line_lst = port_line_lst[:len(port_line_lst) // 2]
-    
-    for line in port_line_lst:
-        # Match groups:
-        # 1: Port number
-        # 2: Protocol
-        # 3: ALLOW or DENY
-        match = re.match(r'^\[\s*\d+\]\s+(\w+)(?:/(tcp|udp))?\s+(ALLOW|DENY)', line)
-        
-        if match is None:
-            raise ValueError(f'Invalid line: {line}')
-        
-        port_num = match.group(1)
-        protocol: Literal['any', 'udp', 'tcp'] = 'any' if match.group(2) is None else match.group(2)  # type: ignore
-        allowed = match.group(3) == 'ALLOW'
-        
-        # Add the port to the list
-        port_lst.append(Port(port_num, allowed, protocol))
+    # Only keep the first half (IPv4 rules are listed before IPv6 rules)
+    port_lst = [
+        Port(port_num.decode('ascii'), allowed, protocol.decode('ascii') or 'any')  # type: ignore
+        for port_num, allowed, protocol in rule_lst[:len(rule_lst) // 2]
+    ]
         
     # Sort by port number
-    port_lst.sort(key=lambda port: port.port_num)
+    port_lst.sort(key=lambda port: port._sort_key)
         
-    return port_lst
+    return port_lst, skipped_lst
+
+
+def add_ports(port_lst: list[Port], max_procs: int = 1) -> list[tuple[Port, str]]:
+    """Add multiple ports, optionally running the ufw calls concurrently
+
+    ufw rules are first-match and every call rewrites the rules file, so by
+    default the calls run one at a time in the given order.
+
+    :param port_lst: Ports to add, allowed or denied based on their state
+    :param max_procs: Maximum amount of ufw calls running at once, defaults to 1
+    :return list[tuple[Port, str]]: Ports that could not be added, with their error message
+    """
+    failed_lst = []
+    proc_lst: list[tuple[Port, subprocess.Popen]] = []
+    
+    def finish(port: Port, proc: subprocess.Popen) -> None:
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            failed_lst.append((port, error_message(stderr, proc.returncode)))
+    
+    for port in port_lst:
+        # Wait for the oldest call to finish before starting a new one
+        if len(proc_lst) >= max_procs:
+            finish(*proc_lst.pop(0))
+        
+        # Capture the output so it is not written over the TUI
+        proc_lst.append((port, subprocess.Popen(
+            _SUDO + ['ufw', 'allow' if port.allowed else 'deny', port.str_port()],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )))
+    
+    for port, proc in proc_lst:
+        finish(port, proc)
+    
+    return failed_lst
+
+
+def keep_sudo_alive(interval: int = 60) -> None:
+    """Refresh the cached sudo credentials in the background
+
+    :param interval: Seconds between refreshes, defaults to 60
+    """
+    def refresh() -> None:
+        while True:
+            time.sleep(interval)
+            subprocess.run(_SUDO + ['-v'], capture_output=True)
+    
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def error_message(stderr: bytes, returncode: int) -> str:
+    """Get a readable message from a failed command
+
+    :param stderr: Error output of the command
+    :param returncode: Exit code of the command
+    :return str: The error output, or the exit code if there was none
+    """
+    message = stderr.decode(errors='replace').strip()
+    return message or f'Command failed with exit code {returncode}'
 
 
 def input_window(stdscr: window, prompt: str) -> str:
@@ -132,49 +245,69 @@ def input_window(stdscr: window, prompt: str) -> str:
 
 def show_popup(
     stdscr: window,
+    pad: window,
     message: str,
-    header: Optional[str] = None,
+    header: str | None = None,
     width_ratio: float = 0.6,
     padding: int = 2
 ) -> None:
     """Show a popup window with a message
 
     :param stdscr: Curses window
+    :param pad: Screen sized pad to draw the popup on
     :param message: Message to display
     :param header: Header to display, defaults to None
     :param width_ratio: Window width ratio, defaults to 0.6
     :param padding: Padding, defaults to 2
     """
     h, w = stdscr.getmaxyx()
+    
+    # The terminal may have been resized since the pad was created
+    if pad.getmaxyx() != (h, w):
+        pad.resize(h, w)
+    
     lines = message.strip().split('\n')
     line_count = len(lines)
 
     # Adjust for header and space for footer
     extra_lines = 3 if header else 2
-    win_h = line_count + extra_lines + padding
+    win_h = min(h, line_count + extra_lines + padding)
     win_w = int(w * width_ratio)
     win_y = max(0, (h - win_h) // 2)
     win_x = max(0, (w - win_w) // 2)
 
-    win = curses.newwin(win_h, win_w, win_y, win_x)
-    win.box()
+    # Reuse the pad, only drawing the border around the popup area
+    pad.erase()
+    pad.hline(0, 1, curses.ACS_HLINE, win_w - 2)
+    pad.hline(win_h - 1, 1, curses.ACS_HLINE, win_w - 2)
+    pad.vline(1, 0, curses.ACS_VLINE, win_h - 2)
+    pad.vline(1, win_w - 1, curses.ACS_VLINE, win_h - 2)
+    pad.addch(0, 0, curses.ACS_ULCORNER)
+    pad.addch(0, win_w - 1, curses.ACS_URCORNER)
+    pad.addch(win_h - 1, 0, curses.ACS_LLCORNER)
+    pad.addch(win_h - 1, win_w - 1, curses.ACS_LRCORNER)
 
     y = 1
     if header:
         centered_header = header.center(win_w - 4)
-        win.addstr(y, 2, centered_header, curses.A_BOLD)
+        pad.addstr(y, 2, centered_header, curses.A_BOLD)
         y += 2  # Space between header and body
 
     for line in lines:
         if y >= win_h - 2:
             break
-        win.addstr(y, 2, line[:win_w - 4])
+        pad.addstr(y, 2, line[:win_w - 4])
         y += 1
 
-    win.addstr(win_h - 1, 2, 'Press any key to continue...')
-    win.refresh()
-    win.getch()
-    win.clear()
+    pad.addstr(win_h - 1, 2, 'Press any key to continue...'[:win_w - 4])
+    pad.refresh(0, 0, win_y, win_x, win_y + win_h - 1, win_x + win_w - 1)
+    
+    # Let the main loop handle a resize that closed the popup
+    if stdscr.getch() == curses.KEY_RESIZE:
+        curses.ungetch(curses.KEY_RESIZE)
+    
+    # Restore what was behind the popup
+    stdscr.touchwin()
     stdscr.refresh()
 
 
@@ -186,37 +319,55 @@ def main(stdscr: window) -> None:
     """
     curses.curs_set(0)
     
-    port_lst = get_ports()
+    port_lst, skipped_lst = get_ports()
+    
+    # Rules (e.g. `22/tcp`) in the list, only used for the duplicate check
+    rule_set = {port.str_port() for port in port_lst}
     current_index = 0
+    start_index = 0
+    needs_redraw = True
+    
+    # Reserve top 2 lines for header
+    max_y, max_x = stdscr.getmaxyx()
+    visible_height = max_y - 2
+    popup_pad = curses.newpad(max_y, max_x)
+    
+    # Let the user know that some rules are missing from the list
+    if skipped_lst:
+        show_popup(
+            stdscr,
+            popup_pad,
+            'These rules can not be managed here:\n' + '\n'.join(skipped_lst),
+            header='Rules not shown'
+        )
     
     while True:
-        # Display the allowed ports
-        stdscr.clear()
-        stdscr.addstr(0, 0, 'UFW Port Manager — h to help, q to quit', curses.A_BOLD)
-        
-        if not port_lst:
-            # Display a message if no ports are found
-            stdscr.addstr(2, 0, 'No ports found (press "a" to add ports)')
-        else:
-            max_y, max_x = stdscr.getmaxyx()
-            
-            # Reserve top 2 lines for header
-            visible_height = max_y - 2
+        if needs_redraw:
+            # Display the allowed ports
+            stdscr.clear()
+            stdscr.addstr(0, 0, 'UFW Port Manager — h to help, q to quit', curses.A_BOLD)
             
-            # Determine the scroll window
-            start_index = max(
-                0,
-                current_index - visible_height + 1
-            ) if current_index >= visible_height else 0
+            # Only move the scroll window when the selection is outside of it
+            if current_index < start_index:
+                start_index = max(0, current_index)
+            elif current_index >= start_index + visible_height:
+                start_index = current_index - visible_height + 1
+            start_index = min(start_index, max(0, len(port_lst) - visible_height))
             end_index = min(len(port_lst), start_index + visible_height)
-
-            # Display the ports and their status
-            for visible_idx, actual_idx in enumerate(range(start_index, end_index)):
-                port_obj = port_lst[actual_idx]
-                attr = curses.A_REVERSE if actual_idx == current_index else 0
-                stdscr.addstr(visible_idx + 2, 0, f'{port_obj.str_port().ljust(15)} {port_obj.str_allowed()}', attr)
+            
+            if not port_lst:
+                # Display a message if no ports are found
+                stdscr.addstr(2, 0, 'No ports found (press "a" to add ports)')
+            else:
+                # Display the ports and their status with a single call, rows
+                # wider than the terminal would wrap and shift the ones below
+                stdscr.addstr(2, 0, '\n'.join(port._display[:max_x - 1] for port in port_lst[start_index:end_index]))
+                stdscr.chgat(current_index - start_index + 2, 0, min(len(port_lst[current_index]._display), max_x - 1), curses.A_REVERSE)
+            
+            needs_redraw = False
         
         key_input = stdscr.getch()
+        prev_index = current_index
         
         # Quit
         if key_input == ord('q'):
@@ -233,60 +384,112 @@ def main(stdscr: window) -> None:
         # Toggle port
         elif key_input == ord(' '):
             if not port_lst:
-                show_popup(stdscr, 'No ports to toggle', header='Error')
+                show_popup(stdscr, popup_pad, 'No ports to toggle', header='Error')
                 continue
             
             # Toggle selectedd port
-            port_lst[current_index].toggle()
+            try:
+                port_lst[current_index].toggle()
+            except subprocess.CalledProcessError as error:
+                show_popup(stdscr, popup_pad, error_message(error.stderr, error.returncode), header='Error')
+                continue
+            
+            needs_redraw = True
         
         # Add new port(s)
         elif key_input == ord('a'):
             user_input = input_window(stdscr, 'Add new ports (spaces in between, `!` for denied): ')
-            if not user_input:
-                continue
             
-            user_input_lst = user_input.split(' ')
+            # The input window swallows a resize, hand it back to the main loop
+            if stdscr.getmaxyx() != (max_y, max_x):
+                curses.ungetch(curses.KEY_RESIZE)
+            
+            new_port_lst = []
+            user_input_lst = user_input.split()
             for port_input in user_input_lst:
-                # Match groups:
-                # 1: Denyed (!) or allowed (empty)
-                # 2: Port number
-                # 3: Protocol
-                match = re.match(r'(!)?(\w+)(?:/(tcp|udp))?', port_input)
-                if match is None:
-                    show_popup(stdscr, f'Invalid port: {port_input}')
-                    continue
-                
-                port = Port(
-                    port_num=match.group(2),
-                    allowed=match.group(1) != '!',
-                    protocol=match.group(3) or 'any'  # type: ignore
-                )
+                # Plain port numbers are the common case, no need for the regex
+                if port_input.isdecimal():
+                    port = Port(port_input, True, 'any')
+                else:
+                    match = _USER_PORT_RE.match(port_input)
+                    if match is None:
+                        show_popup(stdscr, popup_pad, f'Invalid port: {port_input}')
+                        continue
+                    
+                    port = Port(
+                        port_num=match.group(2),
+                        allowed=match.group(1) != '!',
+                        protocol=match.group(3) or 'any'  # type: ignore
+                    )
                 
                 # Skip port if it already existst
-                if port.port_num in [port.port_num for port in port_lst]:
-                    show_popup(stdscr, f'Port {port.port_num} already exists')
+                rule = port.str_port()
+                if rule in rule_set:
+                    show_popup(stdscr, popup_pad, f'Port {rule} already exists')
                     continue
                 
-                if port.allowed:
-                    port.allow()
+                new_port_lst.append(port)
+                rule_set.add(rule)
+            
+            # Only list the ports that ufw actually added
+            failed_lst = add_ports(new_port_lst)
+            failed_ports = {port for port, _ in failed_lst}
+            for port in new_port_lst:
+                if port in failed_ports:
+                    rule_set.discard(port.str_port())
                 else:
-                    port.deny()
-                    
-                port_lst.append(port)
+                    bisect.insort(port_lst, port, key=lambda p: p._sort_key)
+            
+            if failed_lst:
+                show_popup(
+                    stdscr,
+                    popup_pad,
+                    '\n'.join(f'{port.str_port()}: {error}' for port, error in failed_lst),
+                    header='Error'
+                )
+            
+            if len(failed_lst) < len(new_port_lst):
+                needs_redraw = True
+            else:
+                # Nothing was added, only restore what was behind the input window
+                stdscr.touchwin()
 
         # Delete port
         elif key_input == ord('d'):
-            port_lst[current_index].delete()
-            port_lst.pop(current_index)
+            if not port_lst:
+                show_popup(stdscr, popup_pad, 'No ports to delete', header='Error')
+                continue
+            
+            try:
+                port_lst[current_index].delete()
+            except subprocess.CalledProcessError as error:
+                show_popup(stdscr, popup_pad, error_message(error.stderr, error.returncode), header='Error')
+                continue
+            
+            port = port_lst.pop(current_index)
+            
+            # Other rules (e.g. with a different source) may share the same port
+            rule = port.str_port()
+            if all(other.str_port() != rule for other in port_lst):
+                rule_set.discard(rule)
+            
+            needs_redraw = True
             
             # If the current index is out of bounds, set it to the last index
             if current_index >= len(port_lst):
-                current_index = len(port_lst) - 1
+                current_index = max(0, len(port_lst) - 1)
+        
+        # Terminal resized
+        elif key_input == curses.KEY_RESIZE:
+            max_y, max_x = stdscr.getmaxyx()
+            visible_height = max_y - 2
+            needs_redraw = True
         
         # Help winodw
         elif key_input == ord('h'):
             show_popup(
                 stdscr,
+                popup_pad,
                 header='Help',
                 message=(
                     '↑ / ↓  : Navigate\n'
@@ -297,8 +500,22 @@ def main(stdscr: window) -> None:
                 )
             )
         
-        stdscr.refresh()
+        # Only the two highlighted rows change, unless the scroll window moves
+        if current_index != prev_index and not needs_redraw:
+            if start_index <= current_index < start_index + visible_height:
+                prev_row = prev_index - start_index + 2
+                current_row = current_index - start_index + 2
+                stdscr.chgat(prev_row, 0, min(len(port_lst[prev_index]._display), max_x - 1), curses.A_NORMAL)
+                stdscr.chgat(current_row, 0, min(len(port_lst[current_index]._display), max_x - 1), curses.A_REVERSE)
+                stdscr.noutrefresh()
+                curses.doupdate()
+            else:
+                needs_redraw = True
 
 
 if __name__ == '__main__':
+    # Ask for the sudo password before curses takes over the terminal
+    if subprocess.run(['sudo', '-v']).returncode != 0:
+        raise SystemExit('ufw-tui needs sudo privileges to manage ufw')
+    keep_sudo_alive()
     curses.wrapper(main)